@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 
 import sys
+from collections import Counter
 from html import escape
 from itertools import chain
-from typing import Literal, Optional, Sequence, Mapping, Union
+from typing import Dict, List, Optional, Sequence, Mapping, Tuple, Union
 
 import yaml
 from pydantic import BaseModel, Field, validator, root_validator
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader  # type: ignore
+
 
 KEY_W = 55
 KEY_H = 50
@@ -20,6 +26,14 @@ OUTER_PAD_H = KEY_H
 KEYSPACE_W = KEY_W + 2 * INNER_PAD_W
 KEYSPACE_H = KEY_H + 2 * INNER_PAD_H
 LINE_SPACING = 18
+KEY_TYPES = frozenset({None, "held", "combo", "ghost"})
+COMBO_POSITIONS = 2
+
+_RECT_FMT = f'<rect rx="{KEY_RX}" ry="{KEY_RY}" x="%s" y="%s" width="%s" height="%s"%s/>\n'
+_USE_FMT = '<use xlink:href="#%s" x="%s" y="%s"/>\n'
+_KEY_DEF_FMT = '<g id="%s">\n%s</g>\n'
+_XLINK_NS = ' xmlns:xlink="http://www.w3.org/1999/xlink"'
+_CLASS_ATTRS = {cls: f' class="{cls}"' if cls is not None else "" for cls in KEY_TYPES | {"label", "small"}}
 
 STYLE = """
     svg {
@@ -70,15 +84,60 @@ STYLE = """
 class Key(BaseModel):
     tap: str
     hold: str = ""
-    type: Literal[None, "held", "combo", "ghost"] = None
+    type: Optional[str] = None
+
+    @validator("type")
+    def check_type(cls, val):
+        if val not in KEY_TYPES:
+            raise ValueError(f"Key type should be one of {sorted(KEY_TYPES - {None})} or null")
+        return val
 
     @classmethod
     def from_key_spec(cls, key_spec: Union[str, "Key"]) -> "Key":
         if isinstance(key_spec, str):
-            return cls(tap=key_spec)
+            # a bare string is always a valid tap with default fields, skip validation
+            return cls.construct(tap=key_spec)
         return key_spec
 
 
+def _text_template(text: str) -> str:
+    # escaped and line-split SVG text for a label, leaving x, y and class attribute as %-format fields
+    words = [escape(word).replace("%", "%%") for word in text.split()]
+    if not words:
+        return ""
+    if len(words) == 1:
+        return f'<text x="%(x)s" y="%(y)s"%(cls)s>{words[0]}</text>\n'
+    tspans = "".join(f'<tspan x="%(x)s" dy="1.2em">{word}</tspan>\n' for word in words[1:])
+    return (
+        f'<text x="%(x)s" y="%(y)s"%(cls)s>\n'
+        f'<tspan x="%(x)s" dy="-{(len(words) - 1) * 0.6}em">{words[0]}</tspan>{tspans}</text>\n'
+    )
+
+
+class _DrawKey:
+    __slots__ = ("tap", "hold", "type", "tap_text", "hold_text")
+
+    def __init__(self, key: Key) -> None:
+        self.tap = key.tap
+        self.hold = key.hold
+        self.type = key.type
+        self.tap_text = _text_template(key.tap)
+        self.hold_text = _text_template(key.hold)
+
+    def __eq__(self, other: object) -> bool:
+        if self is other:
+            return True
+        if not isinstance(other, _DrawKey):
+            return NotImplemented
+        return (self.tap, self.hold, self.type) == (other.tap, other.hold, other.type)
+
+    def __hash__(self) -> int:
+        return hash((self.tap, self.hold, self.type))
+
+
+_EMPTY_KEY = _DrawKey(Key.construct(tap=""))
+
+
 class ComboSpec(BaseModel):
     positions: Sequence[int]
     key: Key
@@ -91,6 +150,8 @@ class ComboSpec(BaseModel):
 
 KeyRow = Sequence[Optional[Key]]
 KeyBlock = Sequence[KeyRow]
+_DrawKeyRow = Sequence[Optional[_DrawKey]]
+_KeyRun = Tuple[_DrawKey, int]
 
 
 class Layer(BaseModel):
@@ -169,11 +230,12 @@ class KeymapData(BaseModel):
 
     @root_validator(skip_on_failure=True)
     def check_combo_pos(cls, vals):
+        total_keys = vals["layout"].total_keys
         for layer in vals["layers"].values():
             for combo in layer.combos:
-                assert len(combo.positions) == 2, "Cannot have more than two positions for combo"
-                assert all(pos < vals["layout"].total_keys for pos in combo.positions), \
-                    "Combo positions exceed number of keys"
+                assert len(combo.positions) == COMBO_POSITIONS, "Cannot have more than two positions for combo"
+                assert max(combo.positions) < total_keys, "Combo positions exceed number of keys"
+                assert min(combo.positions) >= 0, "Combo positions cannot be negative"
         return vals
 
     @root_validator(skip_on_failure=True)
@@ -202,103 +264,168 @@ class Keymap:
         self.board_w = self.layer_w + 2 * OUTER_PAD_W
         self.board_h = len(self.layers) * self.layer_h + (len(self.layers) + 1) * OUTER_PAD_H
 
+        self._pos_x = [
+            c * KEYSPACE_W + (OUTER_PAD_W if self.layout.split and c >= self.layout.columns else 0)
+            for c in map(self.layout.pos_to_col, range(self.layout.total_keys))
+        ]
+        self._pos_y = [r * KEYSPACE_H for r in map(self.layout.pos_to_row, range(self.layout.total_keys))]
+
+        self._draw_keys: Dict[Tuple[str, str, Optional[str]], _DrawKey] = {}
+        self._placed_rows = {name: self._place_rows(layer) for name, layer in self.layers.items()}
+        # combos always have two positions, checked in KeymapData
+        self._placed_combos = {
+            name: [(*combo.positions, self._to_draw_key(combo.key)) for combo in layer.combos]
+            for name, layer in self.layers.items()
+        }
+
+        self._key_ids = self._shared_key_ids()
+
+        self._buf: List[str] = []
+
+    def _to_draw_key(self, key: Key) -> _DrawKey:
+        # identical keys share a single draw key, so that they can be compared by identity
+        spec = (key.tap, key.hold, key.type)
+        if spec not in self._draw_keys:
+            self._draw_keys[spec] = _DrawKey(key)
+        return self._draw_keys[spec]
+
+    def _to_draw_row(self, row: KeyRow) -> _DrawKeyRow:
+        return [self._to_draw_key(key) if key is not None else None for key in row]
+
+    @staticmethod
+    def _key_runs(row: _DrawKeyRow) -> List[_KeyRun]:
+        runs = []
+        n_keys, i = len(row), 0
+        while i < n_keys:
+            key, width = row[i], 1
+            if key is not None:
+                while i + width < n_keys and row[i + width] is key:
+                    width += 1
+            runs.append((key or _EMPTY_KEY, width))
+            i += width
+        return runs
+
+    def _place_rows(self, layer: Layer) -> List[Tuple[float, float, List[_KeyRun]]]:
+        right_x = self.block_w + OUTER_PAD_W
+        rows = [(0, r * KEYSPACE_H, row) for r, row in enumerate(layer.left)]
+        rows += [(right_x, r * KEYSPACE_H, row) for r, row in enumerate(layer.right)]
+        if self.layout.thumbs:  # thumb row lengths are checked against the layout in KeymapData
+            thumbs_y = self.layout.rows * KEYSPACE_H
+            rows.append(((self.layout.columns - self.layout.thumbs) * KEYSPACE_W, thumbs_y, layer.left_thumbs))
+            rows.append((right_x, thumbs_y, layer.right_thumbs))
+        return [(dx, dy, self._key_runs(self._to_draw_row(row))) for dx, dy, row in rows]
+
+    def _shared_key_ids(self) -> Dict[_KeyRun, str]:
+        # a repeated key is drawn once in <defs> and referenced with <use> only if that makes the SVG smaller;
+        # inline size is measured at the origin and <use> size at the board extent, so both are conservative
+        uses = Counter(run for placed in self._placed_rows.values() for _, _, runs in placed for run in runs)
+        use_len = len(_USE_FMT % ("", self.board_w, self.board_h))
+        key_ids: Dict[_KeyRun, str] = {}
+        saved = 0
+        for run, count in uses.items():
+            key_id = f"key{len(key_ids)}"
+            markup_len = len(self._draw_key(0, 0, *run))
+            cost = len(_KEY_DEF_FMT % (key_id, "")) + count * (use_len + len(key_id))
+            if markup_len * (count - 1) > cost:
+                key_ids[run] = key_id
+                saved += markup_len * count - markup_len - cost
+        if saved <= len(_XLINK_NS) + len("<defs>\n</defs>\n"):
+            return {}
+        return key_ids
+
     @staticmethod
-    def _draw_rect(x: float, y: float, w: float, h: float, cls: Optional[str] = None) -> None:
-        class_str = f' class="{cls}"' if cls is not None else ""
-        print(f'<rect rx="{KEY_RX}" ry="{KEY_RY}" x="{x}" y="{y}" width="{w}" height="{h}"{class_str}/>')
+    def _draw_rect(x: float, y: float, w: float, h: float, cls: Optional[str] = None) -> str:
+        return _RECT_FMT % (x, y, w, h, _CLASS_ATTRS[cls])
 
     @staticmethod
-    def _draw_text(x: float, y: float, text: str, cls: Optional[str] = None) -> None:
-        class_str = f' class="{cls}"' if cls is not None else ""
-        words = text.split()
-        if not words:
-            return
-        if len(words) == 1:
-            print(f'<text x="{x}" y="{y}"{class_str}>{escape(words[0])}</text>')
-            return
-        print(f'<text x="{x}" y="{y}"{class_str}>')
-        print(f'<tspan x="{x}" dy="-{(len(words) - 1) * 0.6}em">{escape(words[0])}</tspan>', end="")
-        for word in words[1:]:
-            print(f'<tspan x="{x}" dy="1.2em">{escape(word)}</tspan>')
-        print('</text>')
-
-    def print_key(self, x: float, y: float, key: Key, width: int = 1) -> None:
+    def _draw_text(x: float, y: float, template: str, cls: Optional[str] = None) -> str:
+        return template % {"x": x, "y": y, "cls": _CLASS_ATTRS[cls]} if template else ""
+
+    def _draw_key(self, x: float, y: float, key: _DrawKey, width: int = 1) -> str:
         key_width = (width * KEY_W) + 2 * (width - 1) * INNER_PAD_W
-        self._draw_rect(x + INNER_PAD_W, y + INNER_PAD_H, key_width, KEY_H, key.type)
-        self._draw_text(x + INNER_PAD_W + key_width / 2, y + KEYSPACE_H / 2, key.tap)
-        self._draw_text(x + INNER_PAD_W + key_width / 2, y + KEYSPACE_H - LINE_SPACING / 2, key.hold, cls="small")
-
-    def print_combo(self, x: float, y: float, combo_spec: ComboSpec) -> None:
-        pos_idx = combo_spec.positions
-
-        cols = [self.layout.pos_to_col(p) for p in pos_idx]
-        rows = [self.layout.pos_to_row(p) for p in pos_idx]
-        x_pos = [x + c * KEYSPACE_W + (OUTER_PAD_W if self.layout.split and c >= self.layout.columns else 0) for c in cols]
-        y_pos = [y + r * KEYSPACE_H for r in rows]
-
-        x_mid, y_mid = sum(x_pos) / len(pos_idx), sum(y_pos) / len(pos_idx)
-
-        self._draw_rect(x_mid + INNER_PAD_W + KEY_W / 4, y_mid + INNER_PAD_H + KEY_H / 4, KEY_W / 2, KEY_H / 2, "combo")
-        self._draw_text(x_mid + KEYSPACE_W / 2, y_mid + INNER_PAD_H + KEY_H / 2, combo_spec.key.tap, cls="small")
-
-    def print_row(self, x: float, y: float, row: KeyRow) -> None:
-        prev_key, width = None, 0
-        for i, key in enumerate(chain(row, [None])):
-            if i > 0 and (prev_key is None or key != prev_key or i == len(row)):
-                self.print_key(x, y, prev_key or Key(tap=""), width=width)
-
-                x += width * KEYSPACE_W
-                width = 0
-
-            prev_key = key
-            width += 1
-
-    def print_block(self, x: float, y: float, block: KeyBlock) -> None:
-        for row in block:
-            self.print_row(x, y, row)
-            y += KEYSPACE_H
-
-    def print_layer(self, x: float, y: float, name: str, layer: Layer) -> None:
-        self._draw_text(KEY_W / 2, y - KEY_H / 2, f"{name}:", cls="label")
-        self.print_block(x, y, layer.left)
-        if layer.right:
-            self.print_block(
-                x + self.block_w + OUTER_PAD_W,
-                y,
-                layer.right,
+        return (
+            self._draw_rect(x + INNER_PAD_W, y + INNER_PAD_H, key_width, KEY_H, key.type)
+            + self._draw_text(x + INNER_PAD_W + key_width / 2, y + KEYSPACE_H / 2, key.tap_text)
+            + self._draw_text(
+                x + INNER_PAD_W + key_width / 2,
+                y + KEYSPACE_H - LINE_SPACING / 2,
+                key.hold_text,
+                cls="small",
             )
-        if self.layout.thumbs and layer.left_thumbs and layer.right_thumbs:
-            self.print_row(
-                x + (self.layout.columns - self.layout.thumbs) * KEYSPACE_W,
-                y + self.layout.rows * KEYSPACE_H,
-                layer.left_thumbs,
-            )
-            self.print_row(
-                x + self.block_w + OUTER_PAD_W, y + self.layout.rows * KEYSPACE_H, layer.right_thumbs
+        )
+
+    def _append_key(self, x: float, y: float, key: _DrawKey, width: int = 1) -> None:
+        key_id = self._key_ids.get((key, width))
+        if key_id is not None:
+            self._buf.append(_USE_FMT % (key_id, x, y))
+        else:
+            self._buf.append(self._draw_key(x, y, key, width))
+
+    def _append_combo(self, x: float, y: float, p_1: int, p_2: int, key: _DrawKey) -> None:
+        pos_x, pos_y = self._pos_x, self._pos_y
+        x_mid = x + (pos_x[p_1] + pos_x[p_2]) * 0.5
+        y_mid = y + (pos_y[p_1] + pos_y[p_2]) * 0.5
+
+        self._buf.append(
+            self._draw_rect(
+                x_mid + INNER_PAD_W + KEY_W / 4,
+                y_mid + INNER_PAD_H + KEY_H / 4,
+                KEY_W / 2,
+                KEY_H / 2,
+                "combo",
             )
-        if layer.combos:
-            for combo_spec in layer.combos:
-                self.print_combo(x, y, combo_spec)
+        )
+        self._buf.append(
+            self._draw_text(x_mid + KEYSPACE_W / 2, y_mid + INNER_PAD_H + KEY_H / 2, key.tap_text, cls="small")
+        )
 
-    def print_board(self) -> None:
-        print(
+    def _append_row(self, x: float, y: float, runs: Sequence[_KeyRun]) -> None:
+        append_key = self._append_key
+        for key, width in runs:
+            append_key(x, y, key, width=width)
+            x += width * KEYSPACE_W
+
+    def _append_layer(self, x: float, y: float, name: str) -> None:
+        self._buf.append(self._draw_text(KEY_W / 2, y - KEY_H / 2, _text_template(f"{name}:"), cls="label"))
+        for dx, dy, runs in self._placed_rows[name]:
+            self._append_row(x + dx, y + dy, runs)
+        for p_1, p_2, key in self._placed_combos[name]:
+            self._append_combo(x, y, p_1, p_2, key)
+
+    def render(self) -> str:
+        self._buf = [
             f'<svg width="{self.board_w}" height="{self.board_h}" viewBox="0 0 {self.board_w} {self.board_h}" '
-            'xmlns="http://www.w3.org/2000/svg">'
-        )
-        print(f"<style>{STYLE}</style>")
+            f'xmlns="http://www.w3.org/2000/svg"{_XLINK_NS if self._key_ids else ""}>\n',
+            f"<style>{STYLE}</style>\n",
+        ]
+        if self._key_ids:
+            self._buf.append("<defs>\n")
+            for (key, width), key_id in self._key_ids.items():
+                self._buf.append(_KEY_DEF_FMT % (key_id, self._draw_key(0, 0, key, width)))
+            self._buf.append("</defs>\n")
 
         x, y = OUTER_PAD_W, 0
-        for name, layer in self.layers.items():
+        for name in self.layers:
             y += OUTER_PAD_H
-            self.print_layer(x, y, name, layer)
+            self._append_layer(x, y, name)
             y += self.layer_h
 
-        print("</svg>")
+        self._buf.append("</svg>\n")
+        svg, self._buf = "".join(self._buf), []
+        return svg
+
+    def print_board(self) -> None:
+        svg = self.render()
+        if hasattr(sys.stdout, "buffer"):
+            sys.stdout.flush()
+            sys.stdout.buffer.write(svg.encode("utf-8"))
+        else:
+            sys.stdout.write(svg)
 
 
 def main() -> None:
     with open(sys.argv[1], "rb") as f:
-        data = yaml.safe_load(f)
+        data = yaml.load(f, Loader=SafeLoader)
     km = Keymap(**data)
     km.print_board()
 